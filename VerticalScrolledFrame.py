@@ -5,6 +5,9 @@ try:
 except ImportError:
 	from tkinter import *
 
+# attributes that get passed on to the outer Frame, only needs working out once
+_WIDGET_ATTRS = frozenset(dir(Widget))
+
 class VerticalScrolledFrame:
     """
     A vertically scrolled Frame that can be treated like any other Frame
@@ -38,10 +41,8 @@ class VerticalScrolledFrame:
         self.canvas.create_window(4, 4, window=self.inner, anchor='nw')
         self.inner.bind("<Configure>", self._on_frame_configure)
 
-        self.outer_attr = set(dir(Widget))
-
     def __getattr__(self, item):
-        if item in self.outer_attr:
+        if item in _WIDGET_ATTRS:
             # geometry attributes etc (eg pack, destroy, tkraise) are passed on to self.outer
             return getattr(self.outer, item)
         else:
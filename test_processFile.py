@@ -0,0 +1,61 @@
+import io
+import unittest
+import zipfile
+
+import thingMac3
+
+
+def zipped(text):
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w") as zf:
+        zf.writestr("results.txt", text)
+    buf.seek(0)
+    return buf
+
+def baseline(text):
+    # the original text mode line parser, users sorted to compare with processFile
+    available = {}
+    for line in io.StringIO(text.decode("utf-8"), newline=None):
+        if line[0] != '!':
+            continue
+        if 'epub' not in line.lower():
+            continue
+        i1 = line.find(' ')
+        i2 = line.find('::')
+        if i2 == -1:
+            i2 = line.find('\r')
+        user = line[:i1]
+        file = line[i1:i2].strip()
+        if file not in available:
+            available[file] = set()
+        available[file].add(user.replace("!", ""))
+    return {file: tuple(sorted(users)) for file, users in available.items()}
+
+
+class ProcessFileTest(unittest.TestCase):
+    def check(self, text):
+        result, expected = thingMac3.processFile(zipped(text)), baseline(text)
+        # only show a few differing rows, diffing whole result dicts takes forever
+        self.assertEqual(sorted(result.items() ^ expected.items())[:6], [])
+
+    def test_lf_without_info(self):
+        self.check(b"header line\n"
+                   b"!carol Some Title.epub\n"
+                   b"!bob Some Title.epub\n"
+                   b"!dave Other Book.EPUB\n"
+                   b"!carol not a book.pdf\n")
+
+    def test_crlf_with_info(self):
+        self.check(b"header line\r\n"
+                   b"!carol Some Title.epub ::INFO:: 1.2MB\r\n"
+                   b"!bob Some Title.epub\r\n"
+                   b"!dave Other Book.epub ::INFO:: 300KB\r\n")
+
+    def test_lines_across_blocks(self):
+        lines = b"".join(b"!user%d Book %d.epub\n" % (i % 7, i) for i in range(20000))
+        self.assertGreater(len(lines), thingMac3.READ_BUFFER_SIZE)
+        self.check(lines)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,6 +1,9 @@
+import atexit
+import io
 import os
+import queue
 import random
-import shlex
+import re
 import struct
 import sys
 import threading
@@ -8,9 +11,10 @@ import time
 import traceback
 import zipfile
 
-from collections import deque
+from collections import OrderedDict, defaultdict, deque
+from functools import lru_cache, partial
 from tkinter import *
-from VerticalScrolledFrame import *
+from tkinter import ttk
 
 import irc.client
 
@@ -28,17 +32,100 @@ IRC_CHANNEL = "#ebooks"
 BOT_NICK = "fetcher" + str(random.randint(1000, 9999))
 HANDLER = "colblitz"
 
+# buffer received dcc file writes in 1M chunks
+DCC_WRITE_BUFFER = 1 << 20
+# acks are the byte count so far as a network order 32 bit int
+DCC_ACK = struct.Struct("!I")
+# search bots send results as e.g. SearchBot_results_for_ some book.txt.zip
+SEARCH_RESULTS_RE = re.compile(r'_results_for_|\.txt\.zip$', re.IGNORECASE)
+# SEND filename address port size, the filename is quoted if it has spaces
+DCC_SEND_RE = re.compile(r'SEND\s+(?:"([^"]+)"|(\S+))\s+(\S+)\s+(\d+)\s+(\d+)')
+
+# number of downloaded book names to remember
+DONE_HISTORY = 100
+
+# seconds to wait for the client to join the channel at startup
+JOIN_TIMEOUT = 60
+
+# seconds between waiting messages while a search is running
+SEARCH_WAIT = 10
+
+# number of searches to keep parsed results for
+SEARCH_CACHE_SIZE = 32
+
+# seconds to wait for the server to say which users are online
+ISON_TIMEOUT = 10
+
+# ms between checks for gui work handed over from other threads
+UI_POLL = 50
+
+# ms to wait after the last filter change before redoing the results list
+FILTER_DELAY = 180
+
+# read the search results in bigger chunks than io.DEFAULT_BUFFER_SIZE (8k)
+READ_BUFFER_SIZE = 128 * 1024
+
+# file types to pick out of the search results, longest first so azw3 beats azw,
+# matched against lowercased text
+FILE_TYPES = ["epub"]
+FILE_TYPE_RE = re.compile((r"\.(?:" + "|".join(map(re.escape, sorted(FILE_TYPES, key=len, reverse=True))) + r")\b").encode())
+
+# lines are written by LogThread so logging threads (dcc packets) never block on stdout
+LOG_BATCH = 64
+LOG_FLUSH = 0.1
+logQueue = queue.SimpleQueue()
+
+def writeLog(lines):
+    try:
+        while len(lines) < LOG_BATCH:
+            lines.append(logQueue.get_nowait())
+    except queue.Empty:
+        pass
+    if lines:
+        sys.stdout.write("".join(lines))
+        sys.stdout.flush()
+
+class LogThread(threading.Thread):
+    def __init__(self, name=None):
+        super(LogThread, self).__init__(name=name, daemon=True)
+
+    def run(self):
+        while 1:
+            # block for the first line and write it with whatever is already queued, then
+            # give more a moment to pile up, lines wait in the queue so drainLog sees them
+            writeLog([logQueue.get()])
+            drainLog()
+            time.sleep(LOG_FLUSH)
+
+def drainLog():
+    while not logQueue.empty():
+        writeLog([])
+
+# started from main, until then (e.g. on import) tLog writes directly
+logThread = None
+
+# (second, formatted) of the last timestamp, only reformatted when the second changes
+lastStamp = (0, "")
+
 def tLog(tName, s):
-    t = time.strftime("%H:%M:%S", time.gmtime())
-    sys.stdout.write("[{} {:12}] {}\n".format(t, tName, s))
-    sys.stdout.flush()
+    global lastStamp
+    now = int(time.time())
+    sec, t = lastStamp
+    if sec != now:
+        t = time.strftime("%H:%M:%S", time.gmtime(now))
+        lastStamp = (now, t)
+    line = "[{} {:12}] {}\n".format(t, tName, s)
+    if logThread is None:
+        sys.stdout.write(line)
+        sys.stdout.flush()
+    else:
+        logQueue.put(line)
 
 
 class QueueThread(threading.Thread):
     def __init__(self, client, name=None):
         super(QueueThread, self).__init__(name=name)
         self.client = client
-        self.count = 0
 
     def log(self, s):
         tLog("Queue", s)
@@ -48,32 +135,41 @@ class QueueThread(threading.Thread):
             self.log(s)
 
     def run(self):
+        client = self.client
         while 1:
-            if not self.client.waitingForFile and len(self.client.queue) > 0:
+            # the client notifies us when a book is queued or it stops waiting for a file
+            with client.queueChanged:
+                client.queueChanged.wait_for(lambda: client.queue and not client.waitingForFile)
                 self.log("Found book in queue, not waiting for file")
                 client.get_book_from_queue()
-            time.sleep(1)
-            self.count += 1
-            if self.count % 10 == 0:
-                self.debug("Waiting, queue size {}".format(len(self.client.queue)))
 
 class IRCCat(irc.client.SimpleIRCClient):
     def __init__(self, target, handler):
         irc.client.SimpleIRCClient.__init__(self)
         self.target = target
         self.received_bytes = 0
+        self.searchResults = None
+        self.isSearchResults = False
         self.handler = handler
 
         self.waitingForFile = None
-        self.latestFile = None
+        self.file = None
         self.latestFilename = None
 
+        self.usersOn = frozenset()
+        self.isOnReceived = threading.Event()
+        self.queueChanged = threading.Condition()
+        self.searchDone = threading.Event()
+        self.joined = threading.Event()
+
         # https://github.com/gehaxelt/python-rss2irc/pull/25
         self.connection.buffer_class.errors = 'replace'
 
         self.queue = deque()
         self.queued = 0
-        self.done = []
+        # only the last few filenames are kept, doneCount has the total
+        self.done = deque(maxlen=DONE_HISTORY)
+        self.doneCount = 0
 
     def log(self, s):
         tLog("Client", s)
@@ -88,43 +184,62 @@ class IRCCat(irc.client.SimpleIRCClient):
     def on_join(self, connection, event):
         if event.source.nick == BOT_NICK:
             self.log("Joined channel")
+            self.joined.set()
 
     def checkIsOn(self, names):
-        self.usersOn = []
+        self.usersOn = frozenset()
+        self.isOnReceived.clear()
         self.connection.ison(names)
 
     def on_ison(self, connection, event):
-        self.usersOn = event.arguments[0].split()
+        self.usersOn = frozenset(event.arguments[0].split())
+        self.isOnReceived.set()
 
     def send_privmsg(self, message):
         self.log("Pming {}: \"{}\"".format(self.handler, message))
         self.connection.privmsg(self.handler, message)
 
+    # checking waitingForFile and sending happen under the queue lock so the gui and the
+    # queue thread can't both send at once, it's reentrant so the queue thread can call
+    # get_book_from_queue while already holding it
     def get_book(self, message):
-        self.queued += 1
-        if self.waitingForFile:
-            self.queue.append(message)
-        else:
-            self.send_channel(message)
-            self.waitingForFile = "Book"
+        with self.queueChanged:
+            self.queued += 1
+            if self.waitingForFile:
+                self.queue.append(message)
+                self.queueChanged.notify()
+            else:
+                self.send_channel(message)
+                self.waitingForFile = "Book"
 
     def get_book_from_queue(self):
-        if self.waitingForFile:
-            self.log("Can't get book from queue, already waiting for file")
-            return
-        self.send_channel(self.queue.popleft())
-        self.waitingForFile = "Book"
+        with self.queueChanged:
+            if self.waitingForFile:
+                self.log("Can't get book from queue, already waiting for file")
+                return
+            self.send_channel(self.queue.popleft())
+            self.waitingForFile = "Book"
+
+    def notifyQueue(self):
+        with self.queueChanged:
+            self.queueChanged.notify()
 
     def send_channel(self, message):
         self.log("To channel {}: {}".format(self.target, message))
         self.connection.privmsg(self.target, message)
 
+    # same locking as get_book, returns False if a file was requested first
     def do_search(self, searchText):
         message = "@search {}".format(searchText)
-        self.log("Searching for \"{}\"".format(searchText))
-        self.log("To channel {}: \"{}\"".format(self.target, message))
-        self.connection.privmsg(self.target, message)
-        self.waitingForFile = "Search"
+        with self.queueChanged:
+            if self.waitingForFile:
+                return False
+            self.log("Searching for \"{}\"".format(searchText))
+            self.log("To channel {}: \"{}\"".format(self.target, message))
+            self.searchDone.clear()
+            self.connection.privmsg(self.target, message)
+            self.waitingForFile = "Search"
+        return True
 
     def on_privmsg(self, connection, event):
         message = event.arguments[0]
@@ -145,54 +260,75 @@ class IRCCat(irc.client.SimpleIRCClient):
             self.log("Got priv notice from {}: {}".format(event.source.nick, message))
         if "returned no matches" in message:
             self.waitingForFile = "NoResults"
+            self.searchDone.set()
 
     def on_ctcp(self, connection, event):
         if event.target == BOT_NICK:
             self.log(event)
-        payload = event.arguments[1]
-        if "SEND" not in payload:
-            return
-        lex = shlex.shlex(payload)
-        lex.whitespace_split = True
-        parts = list(lex)
-        command, filename, peer_address, peer_port, size = parts
-        if command != "SEND":
+        match = DCC_SEND_RE.match(event.arguments[1])
+        if match is None:
             return
+        quoted, filename, peer_address, peer_port, size = match.groups()
+        if quoted is not None:
+            filename = quoted
 
         self.log("Got send request from {} for {}".format(event.source.nick, filename))
-        if filename[0] == "\"" and filename[-1] == "\"":
-            filename = filename[1:-1]
         self.filename = os.path.join(WORKING_DIRECTORY, os.path.basename(filename))
-        self.log("Saving to {}".format(self.filename))
         self.latestFilename = self.filename
-        self.file = open(self.filename, "wb")
+        # decide from the offer itself, a book sent while a search is pending still goes to disk
+        self.isSearchResults = self.waitingForFile == "Search" and SEARCH_RESULTS_RE.search(filename) is not None
+        if self.isSearchResults:
+            # search results are only parsed once, keep them in memory instead of on disk
+            self.log("Keeping {} in memory".format(self.filename))
+            self.file = io.BytesIO()
+        else:
+            self.log("Saving to {}".format(self.filename))
+            self.file = open(self.filename, "wb", buffering=DCC_WRITE_BUFFER)
         peer_address = irc.client.ip_numstr_to_quad(peer_address)
         peer_port = int(peer_port)
         self.dccConnection = self.dcc_connect(peer_address, peer_port, "raw")
 
     def on_dccmsg(self, connection, event):
         data = event.arguments[0]
-        self.debug("Got {} bytes in dcc msg".format(len(data)))
+        size = len(data)
+        # checked here so the message isn't formatted for every packet when not debugging
+        if DEBUG:
+            self.debug("Got {} bytes in dcc msg".format(size))
         self.file.write(data)
-        self.received_bytes = self.received_bytes + len(data)
-        self.dccConnection.send_bytes(struct.pack("!I", self.received_bytes))
+        received = self.received_bytes + size
+        self.received_bytes = received
+        # senders may wait for every ack, so ack each read
+        self.dccConnection.send_bytes(DCC_ACK.pack(received))
 
     def on_dcc_disconnect(self, connection, event):
-        self.file.close()
-        self.latestFile = self.file
-        if self.waitingForFile == "Search":
+        search = self.isSearchResults
+        if search:
+            # left open for the search worker to read back
+            self.file.seek(0)
+            self.searchResults = self.file
+        else:
+            self.file.close()
+        # don't keep the finished file, or the search results buffer, around
+        self.file = None
+        if search:
             self.log("Received search {} ({} bytes).".format(self.filename, self.received_bytes))
         elif self.waitingForFile == "Book":
             self.log("Received book {} ({} bytes).".format(self.filename, self.received_bytes))
             self.done.append(self.latestFilename)
+            self.doneCount += 1
         else:
             self.log("Received file {} ({} bytes).".format(self.filename, self.received_bytes))
-        self.waitingForFile = None
+        # some other file arriving doesn't end a pending search
+        if search or self.waitingForFile != "Search":
+            self.waitingForFile = None
+            self.notifyQueue()
+        if search:
+            self.searchDone.set()
         self.received_bytes = 0
         # ?? - self.connection.quit()
 
     def getStatus(self):
-        return "{} done, {} left".format(len(self.done), self.queued - len(self.done))
+        return "{} done, {} left".format(self.doneCount, self.queued - self.doneCount)
 
     def on_disconnect(self, connection, event):
         self.log("Disconnecting")
@@ -200,6 +336,11 @@ class IRCCat(irc.client.SimpleIRCClient):
 
 
 class ClientThread(threading.Thread):
+    def __init__(self, name=None):
+        super(ClientThread, self).__init__(name=name)
+        self.client = None
+        self.clientCreated = threading.Event()
+
     def log(self, s):
         tLog(self.getName(), s)
 
@@ -210,6 +351,7 @@ class ClientThread(threading.Thread):
             return
 
         self.client = IRCCat(IRC_CHANNEL, HANDLER)
+        self.clientCreated.set()
 
         try:
             self.client.connect(IRC_SERVER, IRC_PORT, BOT_NICK)
@@ -220,49 +362,104 @@ class ClientThread(threading.Thread):
 
         self.client.start()
 
-    def getClient(self):
+    def getClient(self, timeout=None):
+        self.clientCreated.wait(timeout)
         return self.client
 
-def processFile(filename):
+def processFile(source):
+    # source is a path or a file object holding the zipped search results
     try:
-        newfile = filename[:-4]
-        tLog("Processor", "Unzipping file")
-        with zipfile.ZipFile(filename) as zf, open(newfile, 'wb') as f:
-            if len(zf.namelist()) > 1:
+        tLog("Processor", "Opening file")
+        available = defaultdict(set)
+        with zipfile.ZipFile(source) as zf:
+            # one pass over the central directory, and open by ZipInfo to skip the name lookup
+            members = zf.infolist()
+            if len(members) > 1:
+                # this runs on the search thread, where sys.exit would just end the worker quietly
                 tLog("Processor", "File format has changed, more than one file in search zip")
-                sys.exit(1)
-            txtfile = zf.namelist()[0]
-            f.write(zf.read(txtfile))
-
-        tLog("Processor", "Parsing file")
-        available = {}
-        with open(newfile, 'r') as f:
-            for line in f:
-                if line[0] != '!':
-                    continue
-                if 'epub' not in line.lower():
-                    continue
-                i1 = line.find(' ')
-                i2 = line.find('::')
-                if i2 == -1:
-                    i2 = line.find('\r')
-                user = line[:i1]
-                file = line[i1:i2].strip()
-
-                if file not in available:
-                    available[file] = set()
-                available[file].add(user.replace("!", ""))
+                return {}
+            txtfile = members[0]
+
+            # parse straight out of the zip instead of extracting to disk first,
+            # as bytes so only the user and filename of a match get decoded
+            tLog("Processor", "Parsing file")
+            with zf.open(txtfile) as f:
+                # the same few users offer most files, decode each nick once and share it
+                userNames = {}
+
+                # look for the file types over whole blocks in C and only slice out the
+                # lines they are on, carrying the partial last line over to the next block
+                rest = b""
+                while rest is not None:
+                    block = f.read(READ_BUFFER_SIZE)
+                    if block:
+                        block = rest + block
+                        end = block.rfind(b"\n") + 1
+                        rest = block[end:]
+                    else:
+                        block, end, rest = rest, len(rest), None
+
+                    lineEnd = 0
+                    for match in FILE_TYPE_RE.finditer(block.lower(), 0, end):
+                        pos = match.start()
+                        if pos < lineEnd:
+                            continue
+                        lineStart = block.rfind(b"\n", 0, pos) + 1
+                        lineEnd = block.find(b"\n", pos, end)
+                        if lineEnd == -1:
+                            lineEnd = end
+                        if block[lineStart:lineStart + 1] != b'!':
+                            continue
+
+                        # work with offsets into the block so the line itself is never copied
+                        i1 = block.find(b' ', lineStart, lineEnd)
+                        if i1 == -1:
+                            continue
+                        i2 = block.find(b'::', lineStart, lineEnd)
+                        if i2 == -1:
+                            i2 = block.find(b'\r', lineStart, lineEnd)
+                            if i2 == -1:
+                                # lineEnd is already before the \n
+                                i2 = lineEnd
+                        # the leading ! is already known to be there
+                        user = block[lineStart + 1:i1]
+                        file = block[i1:i2].strip()
+                        if not file:
+                            continue
+
+                        name = userNames.get(user)
+                        if name is None:
+                            name = userNames[user] = user.decode("utf-8", "replace")
+                        available[file].add(name)
 
         tLog("Processor", "Got {} unique options".format(len(available)))
-        return available
+        # the sets were only needed to drop duplicates, hand back sorted tuples
+        return {file.decode("utf-8", "replace"): tuple(sorted(users)) for file, users in available.items()}
+    except zipfile.BadZipFile as e:
+        # usually a transfer that was cut short, nothing to parse
+        tLog("Processor", "Bad zip: {}".format(e))
+        return {}
     except Exception as e:
         tLog("Processor", "Error processing file")
         tLog("Processor", str(e))
         return {}
 
 client = None
-elements = []
-searchField, optionsPanel, optionsFilter, optionsList = None, None, None, None
+results, resultKeys, resultOffline, onlineUsers = {}, [], [], frozenset()
+# number of people per row, so filtering doesn't look the sets up again
+resultCounts = []
+resultShown, resultDarker = [], []
+searchField, optionsPanel, optionsFilter, optionsList, optionsListFrame, userMenu = None, None, None, None, None, None
+filterAfterId = None
+# bumped for every search, workers for older searches drop their results
+searchId = 0
+isonLock = threading.Lock()
+# parsed results of recent searches by lowercased query, oldest first
+searchCache = OrderedDict()
+# filter limit the list is currently showing
+lastLimit = 0
+lastStatus = None
+uiQueue = queue.Queue()
 
 def buttonPress(user, file):
     tLog("GUI", "ButtonPress for user {}, file {}".format(user, file))
@@ -271,31 +468,92 @@ def buttonPress(user, file):
     client.get_book(command)
     # client.send_channel(command)
 
+def rowTags(nrow, offline):
+    tags = ["darker"] if nrow % 2 == 0 else []
+    if offline:
+        tags.append("offline")
+    return tags
+
+def showUsers(event):
+    # one row per file, pick who to get it from in a popup
+    iid = optionsList.identify_row(event.y)
+    if not iid:
+        return
+    key = resultKeys[int(iid)]
+    # the same menu is refilled for every popup rather than making a new one each time
+    userMenu.delete(0, END)
+    for person in results[key]:
+        userMenu.add_command(label=person, command=partial(buttonPress, person, key),
+                             state=NORMAL if person in onlineUsers else DISABLED)
+    userMenu.tk_popup(event.x_root, event.y_root)
+
 def updateFilter():
+    global lastLimit
     limit = int(optionsFilter.get())
+    if limit == lastLimit:
+        return
+    lastLimit = limit
     tLog("GUI", "Limit: {}".format(limit))
 
-    # hide all elements, show the ones that pass the filter
+    # only move the rows that appear or disappear, and only retag rows whose shading
+    # changes, so tightening the filter doesn't rebuild the whole list
     nrow = 0
-    for r in elements:
-        ncol = 0
-        for e in r:
-            e.grid_forget()
-        if len(r) - 1 >= limit:
-            for e in r:
-                e.grid(row=nrow, column=ncol, sticky=W+E)
-                e.configure(bg = darkerColor) if nrow % 2 == 0 else e.configure(bg = defaultColor)
-                ncol += 1
+    for i, count in enumerate(resultCounts):
+        if count >= limit:
+            if not resultShown[i]:
+                optionsList.move(str(i), '', nrow)
+                resultShown[i] = True
+            darker = nrow % 2 == 0
+            if resultDarker[i] != darker:
+                optionsList.item(str(i), tags=rowTags(nrow, resultOffline[i]))
+                resultDarker[i] = darker
             nrow += 1
+        elif resultShown[i]:
+            optionsList.detach(str(i))
+            resultShown[i] = False
+
+def scheduleFilter():
+    # wait for the spinbox to settle so holding the arrow down filters once
+    global filterAfterId
+    if filterAfterId is not None:
+        root.after_cancel(filterAfterId)
+    filterAfterId = root.after(FILTER_DELAY, runFilter)
+
+def runFilter():
+    global filterAfterId
+    filterAfterId = None
+    updateFilter()
 
 def skipNext():
 	tLog("GUI", "skipping next")
-	client.waitingForFile = None
-	client.queued -= 1
+	with client.queueChanged:
+		client.waitingForFile = None
+		client.queued -= 1
+		client.queueChanged.notify()
+	# let a search worker waiting for results give up
+	client.searchDone.set()
 
 
+def runOnGUI(func, *args):
+    # tk isn't thread safe, other threads hand gui work over through uiQueue
+    uiQueue.put((func, args))
+
+def drainUI():
+    while True:
+        try:
+            func, args = uiQueue.get_nowait()
+        except queue.Empty:
+            break
+        # one failing callback mustn't stop the pump, later results would never show
+        try:
+            func(*args)
+        except Exception as e:
+            tLog("GUI", "Error in {}: {}".format(func.__name__, e))
+            traceback.print_exc()
+    root.after(UI_POLL, drainUI)
+
 def doSearch():
-    global elements, optionsFilter
+    global results, resultKeys, resultCounts, resultOffline, resultShown, resultDarker, searchId
     if client.waitingForFile:
         tLog("GUI", "Waiting for file, can't search yet")
         return
@@ -303,78 +561,113 @@ def doSearch():
     tLog("GUI", "Do search for: {}".format(searchText))
     searchField.delete(0,END)
 
-    # reset buttons
-    for r in elements:
-        for e in r:
-            e.destroy()
-    elements = []
-
-    tLog("GUI", "Sending to client")
-    client.do_search(searchText)
-
-    # wait until we got the file
-    while client.waitingForFile == "Search":
-        tLog("GUI", "Waiting for file...")
-        time.sleep(1)
-    if client.waitingForFile == "NoResults":
-        client.waitingForFile = None
-        return
-    tLog("GUI", "Got file, going to process")
+    # reset results
+    rows = optionsList.get_children()
+    if rows:
+        optionsList.delete(*rows)
+    results, resultKeys, resultCounts, resultOffline, resultShown, resultDarker = {}, [], [], [], [], []
+
+    # repeated searches reuse the parsed results, only who is online gets checked again
+    query = searchText.strip().lower()
+    available = searchCache.get(query)
+    if available is None:
+        tLog("GUI", "Sending to client")
+        if not client.do_search(searchText):
+            tLog("GUI", "Waiting for file, can't search yet")
+            return
+    else:
+        tLog("GUI", "Using cached results")
+        searchCache.move_to_end(query)
+
+    # wait for and process the results off the gui thread so the window keeps responding,
+    # tagged with the search number so a worker for an older search drops its results
+    searchId += 1
+    searchThread = threading.Thread(target=searchWorker, args=(searchId, query, available), name="SearchThread")
+    searchThread.daemon = True
+    searchThread.start()
+
+def searchWorker(search, query, available=None):
+    if available is None:
+        # wait until we got the file, or the search is skipped or replaced
+        while not client.searchDone.wait(SEARCH_WAIT):
+            tLog("Search", "Waiting for file...")
+        if search != searchId:
+            tLog("Search", "Search was replaced, dropping it")
+            return
+        if client.waitingForFile == "NoResults":
+            client.waitingForFile = None
+            client.notifyQueue()
+            return
+        searchResults, client.searchResults = client.searchResults, None
+        if searchResults is None:
+            tLog("Search", "Search was skipped")
+            return
+        tLog("Search", "Got file, going to process")
+
+        available = processFile(searchResults)
+
+        if len(available) == 0:
+            return
+        searchCache[query] = available
+        if len(searchCache) > SEARCH_CACHE_SIZE:
+            searchCache.popitem(last=False)
 
-    available = processFile(client.latestFilename)
+    allPeople = set().union(*available.values())
 
-    if len(available) == 0:
+    # one ISON at a time, a cached search can start while another worker is still
+    # waiting for its reply and checkIsOn would clear it
+    with isonLock:
+        if search != searchId:
+            tLog("Search", "Search was replaced, dropping it")
+            return
+        # the reply can legitimately be empty, wait for it rather than for someone to be on
+        client.checkIsOn(allPeople)
+        if not client.isOnReceived.wait(ISON_TIMEOUT):
+            tLog("Search", "No ISON reply, showing everyone as offline")
+        online = client.usersOn
+
+    # sort and work out offline rows here rather than on the gui thread
+    keys = sorted(available)
+    counts = [len(available[key]) for key in keys]
+    # whether anyone on a row is online doesn't change until the next search
+    offline = [online.isdisjoint(available[key]) for key in keys]
+    maxPeople = max(counts)
+
+    if search != searchId:
+        tLog("Search", "Search was replaced, dropping it")
         return
+    runOnGUI(showResults, search, available, keys, counts, online, offline, maxPeople)
 
-    maxPeople = 0
-    allPeople = set()
-    for key in available:
-        allPeople.update(available[key])
-        if len(available[key]) > maxPeople:
-            maxPeople = len(available[key])
+def showResults(search, available, keys, counts, online, offline, maxPeople):
+    global results, resultKeys, resultCounts, resultOffline, resultShown, resultDarker, onlineUsers, optionsFilter, lastLimit
 
-    client.checkIsOn(allPeople)
-    while client.usersOn == []:
-        time.sleep(1)
-    onlineUsers = set(client.usersOn)
+    # a newer search may have started after these results were queued
+    if search != searchId:
+        return
 
-    # create filter and buttons
+    # create filter and list
     if not (optionsFilter is None):
         optionsFilter.destroy()
-    optionsList.pack_forget()
-    optionsFilter = Spinbox(optionsPanel, from_=0, to=maxPeople, command=updateFilter)
+    optionsListFrame.pack_forget()
+    optionsFilter = Spinbox(optionsPanel, from_=0, to=maxPeople, command=scheduleFilter)
     optionsFilter.pack(side=TOP, anchor='w')
-    optionsList.pack(side=TOP, expand=YES, fill=BOTH)
-
+    optionsListFrame.pack(side=TOP, expand=YES, fill=BOTH)
+
+    # one row per file instead of a button per user, people are picked from showUsers
+    rows = optionsList.get_children()
+    if rows:
+        optionsList.delete(*rows)
+    results, resultKeys, resultCounts, onlineUsers, resultOffline = available, keys, counts, online, offline
+    resultShown = [True] * len(resultKeys)
+    resultDarker = [nrow % 2 == 0 for nrow in range(len(resultKeys))]
+    lastLimit = 0
     nrow = 0
-    for key in sorted(available.keys()):
-        ncol = 0
-        elements.append([])
-        people = list(available[key])
-        label = Label(optionsList, justify=LEFT, anchor='w', text=key)
-        label.configure(bg = darkerColor) if nrow % 2 == 0 else label.configure(bg = defaultColor)
-
-        label.grid(row=nrow, column=ncol, sticky=W+E)
-        elements[nrow].append(label)
-
-        for person in people:
-            ncol += 1
-            button = Button(optionsList, text=person, command=lambda file=key, user=person: buttonPress(user, file))
-            button.grid(row=nrow, column=ncol, sticky=W+E)
-            button.configure(bg = darkerColor) if nrow % 2 == 0 else button.configure(bg = defaultColor)
-            if not (person in onlineUsers):
-                button.configure(state=DISABLED)
-            elements[nrow].append(button)
-
+    for key in resultKeys:
+        optionsList.insert('', END, iid=str(nrow), text=key, values=(", ".join(available[key]),),
+                           tags=rowTags(nrow, resultOffline[nrow]))
         nrow += 1
 
-def clamp(val, minimum=0, maximum=255):
-    if val < minimum:
-        return minimum
-    if val > maximum:
-        return maximum
-    return val
-
+@lru_cache(maxsize=64)
 def colorscale(hexstr, scalefactor):
     """
     Scales a hex string by ``scalefactor``. Returns scaled hex string.
@@ -395,22 +688,26 @@ def colorscale(hexstr, scalefactor):
     if scalefactor < 0 or len(hexstr) != 6:
         return hexstr
 
-    r, g, b = int(hexstr[:2], 16), int(hexstr[2:4], 16), int(hexstr[4:], 16)
-
-    r = int(clamp(r * scalefactor))
-    g = int(clamp(g * scalefactor))
-    b = int(clamp(b * scalefactor))
+    # parse all three channels at once and pick them out with shifts
+    value = int(hexstr, 16)
+    r = min(255, int((value >> 16) * scalefactor))
+    g = min(255, int((value >> 8 & 0xff) * scalefactor))
+    b = min(255, int((value & 0xff) * scalefactor))
 
-    return "#%02x%02x%02x" % (r, g, b)
+    return "#%06x" % (r << 16 | g << 8 | b)
 
 def updateStatus():
-    global root, status
-    status["text"] = client.getStatus()
-    root.after(200, updateStatus)
+    global root, status, lastStatus
+    # only touch the label when the text changes, and poll slower while idle
+    text = client.getStatus()
+    if text != lastStatus:
+        status["text"] = text
+        lastStatus = text
+    root.after(200 if client.waitingForFile else 500, updateStatus)
 
 
 def makeGUI():
-    global root, defaultColor, darkerColor, searchField, optionsPanel, optionsList, status
+    global root, defaultColor, darkerColor, searchField, optionsPanel, optionsList, optionsListFrame, userMenu, status
     tLog("GUI", "Creating gui")
 
     root = Tk()
@@ -426,7 +723,21 @@ def makeGUI():
     but2 = Button(row, text='Skip', command=skipNext)
 
     optionsPanel = Frame(root)
-    optionsList = VerticalScrolledFrame(optionsPanel)
+    optionsListFrame = Frame(optionsPanel)
+    optionsList = ttk.Treeview(optionsListFrame, columns=("users",))
+    optionsList.heading("#0", text="File", anchor='w')
+    optionsList.heading("users", text="Users", anchor='w')
+    optionsList.column("#0", width=600)
+    optionsList.column("users", width=200)
+    optionsList.tag_configure("darker", background=darkerColor)
+    optionsList.tag_configure("offline", foreground="gray")
+    optionsScroll = Scrollbar(optionsListFrame, orient=VERTICAL, command=optionsList.yview)
+    optionsList.configure(yscrollcommand=optionsScroll.set)
+    optionsScroll.pack(side=RIGHT, fill=Y)
+    optionsList.pack(side=LEFT, expand=YES, fill=BOTH)
+    for sequence in ("<Double-1>", "<Button-2>", "<Button-3>"):
+        optionsList.bind(sequence, showUsers)
+    userMenu = Menu(root, tearoff=0)
 
     row.pack(side=TOP, fill=X)
     status.pack(side=LEFT)
@@ -438,18 +749,24 @@ def makeGUI():
     root.bind('<Return>', (lambda event: doSearch()))
 
     root.after(1, updateStatus)
+    root.after(UI_POLL, drainUI)
     root.mainloop()
 
 
 if __name__ == "__main__":
+    logThread = LogThread(name="LogThread")
+    logThread.start()
+    atexit.register(drainLog)
+
     clientThread = ClientThread(name="ClientThread")
     clientThread.daemon = True
     clientThread.start()
 
-    tLog("Main", "Waiting 35 seconds before creating GUI")
-    time.sleep(35)
-    # time.sleep(35)
-    client = clientThread.getClient()
+    # start the gui as soon as we're in the channel instead of after a fixed wait
+    tLog("Main", "Waiting to join channel before creating GUI")
+    client = clientThread.getClient(JOIN_TIMEOUT)
+    if client is None or not client.joined.wait(JOIN_TIMEOUT):
+        tLog("Main", "Not in channel after {} seconds, creating GUI anyway".format(JOIN_TIMEOUT))
 
     queueThread = QueueThread(client, name="QueueThread")
     queueThread.daemon = True